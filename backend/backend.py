@@ -1,34 +1,68 @@
 import os
 import shutil
-from fastapi import FastAPI, File, UploadFile
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, File, Form, UploadFile, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-import chromadb
-from typing import List
+from typing import List, Optional
 # Hash dependencies
-from utils.hash import add_to_hash_map, get_file_hash_map
+from utils.hash import add_to_hash_map, get_file_hash_map, remove_from_hash_map
 # Embeddding dependencies
-from utils.chat.embedding import get_embeddings
+from utils.chat.embedding import get_embeddings, get_embeddings_path
 # Chat response dependencies
 from utils.chat.chat import get_chat_response
+# Working set dependencies
+from utils.chat.working_set import get_working_sets
+# Generation scheduling dependencies
+from utils.chat.scheduler import GenerationTicket, get_generation_scheduler
 # Vector store depenedencies
-from utils.vector_store.vector_store import chromadb_vector_store
+from utils.vector_store.vector_store import chromadb_vector_store, build_where_filter, delete_from_chromadb, get_collection_name, rebuild_collection
 # Chunk depenedencies
-from utils.chunk import chunk_text
+from utils.chunk import chunk_documents
+# Reconciliation dependencies
+from utils.reconcile import list_uploaded_files, reconcile_storage
 # Extension depenedencies
 from utils.extension import get_file_extension
 # Extractor dependecines 
-from utils.extractor.txt_extractor import extract_text_from_txt
-from utils.extractor.pdf_extractor import extract_text_from_pdf
-from utils.extractor.docx_extractor import extract_text_from_docx
-from utils.extractor.csv_extractor import extract_text_from_csv
-from utils.extractor.xlxs_extractor import extract_text_from_xlsx
+from utils.extractor.txt_extractor import load_documents_from_txt
+from utils.extractor.pdf_extractor import load_documents_from_pdf
+from utils.extractor.docx_extractor import load_documents_from_docx
+from utils.extractor.csv_extractor import load_documents_from_csv
+from utils.extractor.xlxs_extractor import load_documents_from_xlsx
 
 # Class model for the request body
 
+# Seconds between scheduled storage reconciliations, 0 disables the schedule
+RECONCILE_INTERVAL_SECONDS = float(os.getenv("RECONCILE_INTERVAL_SECONDS", "0"))
+
 file_hash_map = get_file_hash_map()
 
+# Serialises changes to uploads and collections with storage reconciliation
+storage_lock = asyncio.Lock()
+
+class Filters(BaseModel):
+    """
+    Model to define optional filters narrowing which parts of the documents are searched.
+    A chunk must match every filter that is set.
+
+    Attributes:
+        page_start (Optional[int]): First PDF page to search, inclusive.
+        page_end (Optional[int]): Last PDF page to search, inclusive.
+        sheets (Optional[List[str]]): Spreadsheet sheet names to search.
+        row_start (Optional[int]): First spreadsheet row to search, inclusive.
+        row_end (Optional[int]): Last spreadsheet row to search, inclusive.
+        sections (Optional[List[str]]): Document section headings to search.
+    """
+    page_start: Optional[int] = None
+    page_end: Optional[int] = None
+    sheets: Optional[List[str]] = None
+    row_start: Optional[int] = None
+    row_end: Optional[int] = None
+    sections: Optional[List[str]] = None
+
 class Data(BaseModel):
     """
     Model to define the request body for asking questions.
@@ -36,13 +70,55 @@ class Data(BaseModel):
     Attributes:
         question (str): The question to be answered.
         file_names (List[str]): List of file names to search for answers.
+        user_id (Optional[str]): Identifies the user for fair queueing. Defaults to the client address.
+        filters (Optional[Filters]): Restricts the search to pages, sheets, rows or sections.
+        conversation_id (Optional[str]): Identifies the chat, so follow-up questions can reuse recently retrieved chunks.
     """
     question: str 
     file_names: List[str] 
+    user_id: Optional[str] = None
+    filters: Optional[Filters] = None
+    conversation_id: Optional[str] = None
 
 
+# Periodically reconcile storage in the background
+async def run_scheduled_reconciliation(interval):
+    """
+    Runs the storage reconciliation job every `interval` seconds.
+
+    Args:
+        interval (float): Seconds between runs.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with storage_lock:
+                await run_in_threadpool(reconcile_storage)
+        except Exception as e:
+            print(f"Error running scheduled reconciliation: {e}")
+
+# Start background jobs with the app and stop them on shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Runs the scheduled storage reconciliation while the app is up, if
+    RECONCILE_INTERVAL_SECONDS is set.
+    """
+    reconcile_task = None
+    if RECONCILE_INTERVAL_SECONDS > 0:
+        reconcile_task = asyncio.create_task(run_scheduled_reconciliation(RECONCILE_INTERVAL_SECONDS))
+    try:
+        yield
+    finally:
+        if reconcile_task is not None:
+            reconcile_task.cancel()
+            try:
+                await reconcile_task
+            except asyncio.CancelledError:
+                pass
+
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Allow CORS for all origins (development purposes)
 app.add_middleware(
@@ -91,72 +167,119 @@ async def upload_file(file: UploadFile = File(...)):
     except Exception as e:
         return {"error": str(e)}
 
-# Function to extract text based on file type
-def extract_text(file_path):
+# Function to find other files stored under the same collection name
+def get_files_sharing_collection(file_name):
+    """
+    Finds other registered or uploaded files whose collection name matches this
+    file's, e.g. `report.pdf` and `report.docx`.
+
+    Args:
+        file_name (str): The name of the file.
+
+    Returns:
+        List[str]: The other file names, sorted.
+    """
+    collection_name = get_collection_name(file_name)
+    return sorted(
+        name for name in set(file_hash_map) | list_uploaded_files()
+        if name != file_name and get_collection_name(name) == collection_name
+    )
+
+# Function to load a file as documents carrying structural metadata
+def extract_documents(file_path):
     """
-    Extracts text from a file based on its extension.
+    Loads a file as documents based on its extension, keeping structure such as
+    page numbers, sheet names, row ranges and section headings as metadata.
 
     Args:
         file_path (str): Path to the file.
 
     Returns:
-        str: Extracted text from the file.
+        List[Document]: Documents loaded from the file.
     """
     try:
         ext = get_file_extension(file_path)
         if ext == '.pdf':
-            return extract_text_from_pdf(file_path)
+            return load_documents_from_pdf(file_path)
         elif ext == '.docx':
-            return extract_text_from_docx(file_path)
+            return load_documents_from_docx(file_path)
         elif ext == '.txt':
-            return extract_text_from_txt(file_path)
+            return load_documents_from_txt(file_path)
         elif ext == '.csv':
-            return extract_text_from_csv(file_path)
+            return load_documents_from_csv(file_path)
         elif ext == '.xlsx':
-            return extract_text_from_xlsx(file_path)
+            return load_documents_from_xlsx(file_path)
         else:
             raise ValueError("Unsupported file type")
     except Exception as e:
-        print(f"Error extracting text: {e}")
-        return ""
+        print(f"Error extracting documents: {e}")
+        return []
 
 # FastAPI endpoint to handle file upload and embedding
 @app.post("/process-file/")
-async def process_file(file: UploadFile = File(...)):
+async def process_file(
+    file: UploadFile = File(...),
+    hnsw_m: Optional[int] = Form(None),
+    construction_ef: Optional[int] = Form(None),
+    search_ef: Optional[int] = Form(None),
+):
     """
     Endpoint to process an uploaded file, extract text, generate embeddings, and store them in ChromaDB.
 
     Parameters:
     file (UploadFile): The file uploaded by the user.
+    hnsw_m (Optional[int]): HNSW `M` for the file's collection. Defaults to HNSW_M.
+    construction_ef (Optional[int]): HNSW `construction_ef` for the collection. Defaults to HNSW_CONSTRUCTION_EF.
+    search_ef (Optional[int]): HNSW `search_ef` for the collection. Defaults to HNSW_SEARCH_EF.
 
     Returns:
     JSONResponse: A response indicating the success or failure of the file processing.
     """
     try:
-        upload_response = await upload_file(file)
-        file_path = upload_response["file_path"]
-        content = extract_text(file_path)
-        chunks = chunk_text(content)
-        embeddings = get_embeddings(file.filename, "all-minilm", chunks)
-        collection_name = file.filename.replace(" ", "_").split(".")[0]
-        chromadb_vector_store(embeddings, chunks, collection_name=collection_name)
-        add_to_hash_map(file.filename)
-        return {"message": "File processed and embeddings stored successfully"}
+        # Held until the file is registered, so reconciliation never sees it half processed
+        async with storage_lock:
+            # Files are stored under a collection named after the file without its extension
+            conflicts = get_files_sharing_collection(file.filename)
+            if conflicts:
+                return JSONResponse(status_code=400, content={
+                    "error": f"{file.filename} would share its collection with {', '.join(conflicts)}; rename the file"})
+
+            upload_response = await upload_file(file)
+            file_path = upload_response["file_path"]
+            documents = extract_documents(file_path)
+            chunks = chunk_documents(documents)
+            texts = [chunk.page_content for chunk in chunks]
+            embeddings = get_embeddings(file.filename, "all-minilm", texts)
+            collection_name = get_collection_name(file.filename)
+            hnsw_config = {"m": hnsw_m, "construction_ef": construction_ef, "search_ef": search_ef}
+            collection = chromadb_vector_store(embeddings, texts, collection_name=collection_name,
+                                               metadatas=[chunk.metadata for chunk in chunks], hnsw_config=hnsw_config)
+            if collection is None:
+                return JSONResponse(status_code=500, content={"error": f"Failed to store embeddings for {file.filename}"})
+            get_working_sets().invalidate(collection_name)
+            add_to_hash_map(file.filename)
+            return {"message": "File processed and embeddings stored successfully"}
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 # FastAPI endpoint to ask questions based on the document
 @app.post("/ask-question/")
-async def ask_question(data: Data):
+async def ask_question(data: Data, request: Request):
     """
     Endpoint to ask questions based on the uploaded documents. 
     It retrieves the relevant chunks from the documents and streams the generated response.
 
+    Generations are admitted through a bounded, per-user fair queue. The queue
+    position is streamed as `queue` events, and can also be polled at
+    `/generation-queue/{request_id}` using the `X-Request-ID` response header.
+
     Parameters:
-    data (Data): The data containing the question and the list of file names to query.
+    data (Data): The data containing the question, the list of file names to query and optional filters.
+    request (Request): The incoming request, used to identify the client.
 
     Returns:
-    StreamingResponse: A stream of the generated response based on the documents.
+    StreamingResponse: A stream of server-sent events carrying queue updates, the
+    generated response, and finally its sources and timings.
     """
     try:
         question = data.question
@@ -174,32 +297,54 @@ async def ask_question(data: Data):
                 return JSONResponse(status_code=400, content={"error": f"File not found: {file_name}"})
             
             # Modify the file name to match the format used when storing embeddings
-            modified_file_name = file_name.replace(" ", "_").split(".")[0]
+            modified_file_name = get_collection_name(file_name)
             modified_file_names.append(modified_file_name)
 
+        # Narrow the search to the requested pages, sheets, rows or sections
+        where = build_where_filter(**data.filters.model_dump()) if data.filters else None
+
+        # Queue the generation, falling back to the client address to identify the user
+        user_id = data.user_id or (request.client.host if request.client else "anonymous")
+        ticket = GenerationTicket(user_id)
+        headers = {
+            "X-Request-ID": ticket.request_id,
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # Stop reverse proxies from buffering events
+        }
+
         # StreamingResponse to stream the response
-        return StreamingResponse(get_chat_response(question, modified_file_names), media_type='text/event-stream')
+        return StreamingResponse(
+            get_chat_response(question, modified_file_names, ticket, where, data.conversation_id),
+            media_type='text/event-stream',
+            headers=headers,
+        )
 
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
     
     
-# Function to delete the embeddings and collection from ChromaDB
-def delete_from_chromadb(collection_name):
+# FastAPI endpoint to check a request's place in the generation queue
+@app.get("/generation-queue/{request_id}")
+async def generation_queue_status(request_id: str):
     """
-    Delete a collection and its associated embeddings from ChromaDB.
+    Endpoint to report the state and queue position of a question.
 
     Parameters:
-    collection_name (str): The name of the collection to delete.
+    request_id (str): The id returned in the `X-Request-ID` header of `/ask-question/`.
+
+    Returns:
+    dict: The request state, its 1-based queue position (0 once generating) and scheduler stats.
     """
-    try:
-        client = chromadb.HttpClient(host='localhost', port=8001)  # ChromaDB port
-        collection = client.get_collection(name=collection_name)
-        if collection:
-            client.delete_collection(collection_name)
-            print(f"Collection {collection_name} deleted from ChromaDB")
-    except Exception as e:
-        print(f"Error deleting collection from ChromaDB: {e}")
+    scheduler = get_generation_scheduler()
+    ticket = scheduler.get_ticket(request_id)
+    if ticket is None:
+        return JSONResponse(status_code=404, content={"error": f"Unknown or finished request: {request_id}"})
+    return {
+        "request_id": request_id,
+        "state": ticket.state,
+        "position": scheduler.position(ticket),
+        **scheduler.stats(),
+    }
 
 # FastAPI endpoint to delete a file and its associated data
 @app.post("/delete-file/")
@@ -214,27 +359,99 @@ async def delete_file(file_name: str):
     JSONResponse: A response indicating the success or failure of the file deletion.
     """
     try:
-        # Delete the file from the uploads directory
-        file_path = os.path.join("uploads", file_name)
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        async with storage_lock:
+            # Delete the file from the uploads directory
+            file_path = os.path.join("uploads", file_name)
+            if os.path.exists(file_path):
+                os.remove(file_path)
         
-        # Delete the embeddings and collection from ChromaDB
-        delete_from_chromadb(file_name)
+            # Delete the embeddings and collection from ChromaDB, stored under the derived collection name,
+            # unless another file is still stored under the same name
+            if not get_files_sharing_collection(file_name):
+                delete_from_chromadb(get_collection_name(file_name))
+                get_working_sets().invalidate(get_collection_name(file_name))
+
+            # Remove the file from the hash map
+            remove_from_hash_map(file_name)
+
+            # Optionally, delete the saved embeddings file
+            embeddings_file = get_embeddings_path(file_name)
+            if os.path.exists(embeddings_file):
+                os.remove(embeddings_file)
+
+            return {"message": "File and associated data deleted successfully"}
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
 
-        # Remove the file from the hash map
-        if file_name in file_hash_map:
-            del file_hash_map[file_name]
+# FastAPI endpoint to change the HNSW settings of a file's collection
+@app.post("/tune-collection/")
+async def tune_collection(file_name: str, hnsw_m: Optional[int] = None,
+                          construction_ef: Optional[int] = None, search_ef: Optional[int] = None):
+    """
+    Endpoint to rebuild a file's collection with new HNSW settings, e.g. the ones
+    recommended by `python -m utils.vector_store.calibrate --file`. Unset values keep
+    their current setting.
+
+    The new index is built alongside the live one, which is then deleted and replaced
+    by it. Questions on this file wait out that brief swap instead of failing; other
+    clients of the same ChromaDB server may briefly see the collection missing.
 
-        # Optionally, delete the saved embeddings file
-        embeddings_file = os.path.join("embeddings", f"{file_name}.json")
-        if os.path.exists(embeddings_file):
-            os.remove(embeddings_file)
+    Parameters:
+    file_name (str): The name of the file whose collection to rebuild.
+    hnsw_m (Optional[int]): HNSW `M`.
+    construction_ef (Optional[int]): HNSW `construction_ef`.
+    search_ef (Optional[int]): HNSW `search_ef`.
 
-        return {"message": "File and associated data deleted successfully"}
+    Returns:
+    JSONResponse: The collection's new HNSW settings, or an error.
+    """
+    try:
+        if file_name not in file_hash_map:
+            return JSONResponse(status_code=400, content={"error": f"File not found: {file_name}"})
+
+        hnsw_config = {"m": hnsw_m, "construction_ef": construction_ef, "search_ef": search_ef}
+        async with storage_lock:
+            metadata = await run_in_threadpool(rebuild_collection, get_collection_name(file_name), hnsw_config)
+        # Chunk ids survive a rebuild, but a failed one may have lost or recreated the collection
+        get_working_sets().invalidate(get_collection_name(file_name))
+        if metadata is None:
+            return JSONResponse(status_code=500, content={"error": f"Failed to rebuild collection for {file_name}"})
+        return {"message": "Collection rebuilt successfully", "metadata": metadata}
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+# FastAPI endpoint to report how often conversations reuse their working sets
+@app.get("/metrics/working-set")
+async def working_set_metrics():
+    """
+    Endpoint to report conversation working set reuse.
+
+    Returns:
+    dict: Hits, misses, topic drifts, reuse rate and the number of tracked conversations.
+    """
+    return get_working_sets().stats()
+
+# FastAPI endpoint to reconcile storage on demand
+@app.post("/admin/reconcile/")
+async def reconcile(dry_run: bool = False, include_unmanaged: bool = False):
+    """
+    Endpoint to cross-check uploads, saved embeddings, ChromaDB collections and the
+    file registry, deleting orphans.
+
+    Parameters:
+    dry_run (bool): Only report what would be deleted.
+    include_unmanaged (bool): Also delete orphaned collections without the managed flag,
+        e.g. ones left by earlier versions of this app. They are always listed in the report.
+
+    Returns:
+    dict: The reconciliation report, including the vectors and bytes reclaimed.
+    """
+    try:
+        async with storage_lock:
+            return await run_in_threadpool(reconcile_storage, dry_run, include_unmanaged)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
 
 
 # Run the FastAPI app
@@ -0,0 +1,219 @@
+import os
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional
+
+import ollama
+import chromadb
+# Vector store depenedencies
+from utils.vector_store.vector_store import wait_for_swap
+
+# Tunables for request coalescing
+MAX_BATCH_SIZE = int(os.getenv("RETRIEVAL_MAX_BATCH_SIZE", "16"))
+MAX_WAIT_MS = float(os.getenv("RETRIEVAL_MAX_WAIT_MS", "5"))
+# Collection queries run at once, across batches
+QUERY_WORKERS = int(os.getenv("RETRIEVAL_QUERY_WORKERS", "4"))
+
+# Per-query fields of a `collection.query` response
+QUERY_RESULT_KEYS = ("ids", "distances", "documents", "metadatas", "embeddings")
+QUERY_INCLUDE = ["documents", "metadatas", "distances"]
+
+
+class _RetrievalJob:
+    """
+    A single question waiting to be embedded and/or queried.
+
+    Attributes:
+        question (str): The question text, used when no embedding is given.
+        collections (List[str]): The collections to query. May be empty to only embed.
+        n_results (int): Number of results to fetch per collection.
+        where (dict): Optional ChromaDB metadata filter applied to every collection.
+        embedding (List[float]): A precomputed embedding, or None to compute one.
+        include_embeddings (bool): Whether to fetch the chunk embeddings too.
+        future (Future): Resolved with a tuple of (embedding, results_list).
+    """
+    def __init__(self, question, collections, n_results, where, embedding, include_embeddings):
+        self.question = question
+        self.collections = list(collections)
+        self.n_results = n_results
+        self.where = where
+        self.embedding = embedding
+        self.include_embeddings = include_embeddings
+        self.future = Future()
+
+
+class _PendingResults:
+    """
+    Gathers the per-collection query results of one batch and resolves each job
+    once all of its collections have answered.
+    """
+    def __init__(self, groups):
+        self._lock = threading.Lock()
+        self._results = {}
+        self._remaining = {}
+        for jobs in groups.values():
+            for job in jobs:
+                self._results.setdefault(id(job), {})
+                self._remaining[id(job)] = self._remaining.get(id(job), 0) + 1
+
+    def resolve(self, collection_name, jobs, response=None, error=None):
+        with self._lock:
+            for row, job in enumerate(jobs):
+                self._remaining[id(job)] -= 1
+                if job.future.done():
+                    continue
+                if error is not None:
+                    job.future.set_exception(error)
+                    continue
+                # Slice the batched response back into a single-query result
+                self._results[id(job)][collection_name] = {
+                    key: [response[key][row]] for key in QUERY_RESULT_KEYS
+                    if response.get(key) is not None
+                }
+                if not self._remaining[id(job)]:
+                    job.future.set_result(
+                        (job.embedding, [self._results[id(job)][name] for name in job.collections]))
+
+
+class RetrievalBatcher:
+    """
+    Coalesces concurrent questions into one batched embedding call and one
+    batched `collection.query` per collection.
+
+    A single worker thread drains the pending queue. A lone request is dispatched
+    immediately; only when several requests are already pending does the worker
+    hold the batch open for up to `max_wait_ms` to let it fill. Once a batch is
+    embedded, its collection queries run on a small thread pool, so different
+    collections are queried in parallel while the worker embeds the next batch.
+    """
+    def __init__(self, model="all-minilm", max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS,
+                 query_workers=QUERY_WORKERS):
+        self.model = model
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue = queue.Queue()
+        self._clients = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, int(query_workers)),
+                                            thread_name_prefix="retrieval-query")
+        self._worker = threading.Thread(target=self._run, name="retrieval-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, question, collections: List[str], n_results=5, where: Optional[dict] = None,
+               embedding: Optional[List[float]] = None, include_embeddings=False):
+        """
+        Queue a question and block until its batch has been processed.
+
+        Parameters:
+        question (str): The question to embed.
+        collections (List[str]): The collections to query.
+        n_results (int): Number of results to fetch per collection.
+        where (dict): Optional ChromaDB metadata filter applied to every collection.
+        embedding (List[float]): Optional precomputed embedding for the question.
+        include_embeddings (bool): Also fetch each result's chunk embedding, e.g. to rescore it later.
+
+        Returns:
+        tuple: The question embedding and a list of per-collection query results,
+        shaped like the output of `collection.query` for a single query.
+        """
+        job = _RetrievalJob(question, collections, n_results, where, embedding, include_embeddings)
+        self._queue.put(job)
+        return job.future.result()
+
+    def _get_client(self):
+        # One client per query thread
+        client = getattr(self._clients, "client", None)
+        if client is None:
+            client = self._clients.client = chromadb.HttpClient(host='localhost', port=8001)  # ChromaDB port
+        return client
+
+    def _collect_batch(self):
+        """
+        Block for the first job, then gather whatever else is pending.
+        """
+        batch = [self._queue.get()]
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        # Only wait for stragglers when we are already seeing concurrent load
+        if len(batch) > 1 and self.max_wait > 0:
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            try:
+                self._process(batch)
+            except Exception as e:
+                print(f"Error processing retrieval batch: {e}")
+                for job in batch:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+
+    def _process(self, batch):
+        # One embedding call for every job that still needs one
+        to_embed = [job for job in batch if job.embedding is None]
+        if to_embed:
+            response = ollama.embed(model=self.model, input=[job.question for job in to_embed])
+            for job, embedding in zip(to_embed, response["embeddings"]):
+                job.embedding = embedding
+
+        # Group jobs by (collection, n_results, filter, include) so each collection is queried once per filter
+        groups = {}
+        for job in batch:
+            where_key = json.dumps(job.where, sort_keys=True) if job.where else None
+            for collection_name in job.collections:
+                groups.setdefault(
+                    (collection_name, job.n_results, where_key, job.include_embeddings), []).append(job)
+            if not job.collections:
+                job.future.set_result((job.embedding, []))
+
+        # Hand the queries to the pool and go back to collecting the next batch
+        pending = _PendingResults(groups)
+        for (collection_name, n_results, _, include_embeddings), jobs in groups.items():
+            self._executor.submit(self._query, pending, collection_name, n_results, include_embeddings, jobs)
+
+    def _query(self, pending, collection_name, n_results, include_embeddings, jobs):
+        try:
+            wait_for_swap(collection_name)
+            collection = self._get_client().get_collection(name=collection_name)
+            response = collection.query(
+                query_embeddings=[job.embedding for job in jobs], n_results=n_results,
+                where=jobs[0].where or None,
+                include=(QUERY_INCLUDE + ["embeddings"]) if include_embeddings else QUERY_INCLUDE)
+        except Exception as e:
+            pending.resolve(collection_name, jobs, error=e)
+            return
+        pending.resolve(collection_name, jobs, response=response)
+
+
+_retrieval_batcher = None
+_retrieval_batcher_lock = threading.Lock()
+
+
+def get_retrieval_batcher():
+    """
+    Get the process-wide retrieval batcher, creating it on first use.
+
+    Returns:
+    RetrievalBatcher: The shared batcher instance.
+    """
+    global _retrieval_batcher
+    with _retrieval_batcher_lock:
+        if _retrieval_batcher is None:
+            _retrieval_batcher = RetrievalBatcher()
+        return _retrieval_batcher
@@ -1,83 +1,224 @@
+import time
+import asyncio
 import ollama
-import chromadb
-from typing import List, Generator
+from typing import List, AsyncGenerator
+from utils.chat.batcher import get_retrieval_batcher
+from utils.chat.scheduler import GenerationTicket, get_generation_scheduler
+from utils.chat.sse import TokenCoalescer, format_sse
+from utils.chat.working_set import get_working_sets
 
-def get_chat_response(question, collections: List[str]) -> Generator[str, None, None]:
+# How often a queued request is told its position, in seconds
+QUEUE_UPDATE_INTERVAL = 1.0
+
+# Function to retrieve the chunks a question should be answered from
+def retrieve_context(question, collections: List[str], where=None, conversation_id=None):
+    """
+    Retrieve the most relevant chunks for a question.
+
+    Parameters:
+    question (str): The question to ask.
+    collections (List[str]): The list of collections to query.
+    where (dict): Optional ChromaDB metadata filter narrowing the search, e.g. to a page range or sheet.
+    conversation_id (str): Optional conversation the question belongs to. Follow-up questions
+        close to the conversation's recently retrieved chunks are answered from those chunks
+        without querying ChromaDB again.
+
+    Returns:
+    tuple: The top results and how they were retrieved ("full" or "working_set").
+    """
+    batcher = get_retrieval_batcher()
+    working_sets = get_working_sets()
+    prompt_embedding = None
+    if conversation_id:
+        # Embed the question first and try the conversation's working set before going to ChromaDB
+        prompt_embedding, _ = batcher.submit(question, [])
+        top_results = working_sets.lookup(conversation_id, collections, where, prompt_embedding)
+        if top_results is not None:
+            return top_results, "working_set"
+
+    # Embed the question and query all collections, batched with concurrent requests
+    # Chunk embeddings are only needed to rescore them later in the conversation
+    prompt_embedding, results_list = batcher.submit(
+        question, collections, n_results=5, where=where, embedding=prompt_embedding,
+        include_embeddings=bool(conversation_id))
+
+    # Combine results and select the top 7 chunks
+    top_results = select_top_results(results_list, collections)
+    if conversation_id:
+        working_sets.store(conversation_id, collections, where, prompt_embedding,
+                           select_top_results(results_list, collections, top_n=None))
+    return top_results, "full"
+
+async def get_chat_response(question, collections: List[str], ticket=None, where=None,
+                            conversation_id=None) -> AsyncGenerator[str, None]:
     """
     Generate a chat response based on the provided question and document collections.
 
+    The ticket joins the generation queue once retrieval is done and waits for a
+    slot on the event loop, so queued requests hold no threads. The Ollama stream
+    runs as a task attached to the ticket: cancelling the ticket, or tearing down
+    this stream when the client disconnects, closes it immediately.
+
+    The response is a stream of server-sent events:
+    `queue` ({"position": int}) while waiting for a generation slot,
+    `token` ({"text": str}) carrying tokens coalesced over a short window,
+    `done` ({"sources": [...], "timings": {...}, "retrieval": "full" | "working_set"}) once generation finishes, and
+    `error` ({"error": str}) if anything fails.
+
     Parameters:
     question (str): The question to ask.
     collections (List[str]): The list of collections to query.
+    ticket (GenerationTicket): The request's ticket, not yet queued.
+        A new anonymous ticket is used if none is given.
+    where (dict): Optional ChromaDB metadata filter narrowing the search, e.g. to a page range or sheet.
+    conversation_id (str): Optional conversation the question belongs to, see `retrieve_context`.
 
     Yields:
-    str: A portion of the chat response.
+    str: A framed server-sent event.
     """
+    scheduler = get_generation_scheduler()
+    if ticket is None:
+        ticket = GenerationTicket("anonymous")
+    generation = None
+    completed = False
     try:
         SYSTEM_PROMPT = """You are a helpful reading assistant who answers questions 
         based on snippets of text provided in context. Answer only using the context provided, 
         being as concise as possible. If you're unsure, just say that you don't know.
         Context:
     """
-        prompt_embedding = ollama.embeddings(
-            model="all-minilm", prompt=question)["embedding"]
-
-        # Collect results from all specified collections
-        results_list = []
-        client = chromadb.HttpClient(host='localhost', port=8001)
-        for collection_name in collections:
-            collection = client.get_collection(name=collection_name)
-            results = collection.query(query_embeddings=[prompt_embedding], n_results=5)
-            results_list.append(results)
+        started = time.monotonic()
+        top_results, retrieval = await asyncio.to_thread(
+            retrieve_context, question, collections, where, conversation_id)
+        top_chunks = [result["document"] for result in top_results]
+        retrieved = time.monotonic()
 
-        # Combine results and select the top 5 chunks
-        top_chunks = combine_and_select_top_chunks(results_list)
+        # Wait for a generation slot, reporting the queue position
+        scheduler.enqueue(ticket)
+        last_position = None
+        timeout = 0
+        while not await scheduler.wait(ticket, timeout=timeout):
+            if ticket.state != "queued":
+                return
+            position = scheduler.position(ticket)
+            if position != last_position:
+                last_position = position
+                yield format_sse("queue", {"position": position})
+            timeout = QUEUE_UPDATE_INTERVAL
+        admitted = time.monotonic()
 
         # Generate response based on selected chunks
-        response = ollama.chat(
-            model="llama3",
-            messages=[
+        tokens = asyncio.Queue()
+
+        async def generate():
+            try:
+                response = await ollama.AsyncClient().chat(
+                    model="llama3",
+                    messages=[
+                        {
+                            "role": "system",
+                            "content": SYSTEM_PROMPT + "\n".join(top_chunks),
+                        },
+                        {"role": "user", "content": question},
+                    ],
+                    stream=True
+                )
+                async for chunk in response:
+                    tokens.put_nowait(chunk["message"]["content"])
+            finally:
+                tokens.put_nowait(None)
+
+        generation = asyncio.create_task(generate())
+        scheduler.attach(ticket, generation)
+
+        coalescer = TokenCoalescer()
+        first_token = None
+        while (token := await tokens.get()) is not None:
+            if first_token is None:
+                first_token = time.monotonic()
+            # print(token)
+            if (event := coalescer.add(token)) is not None:
+                yield event
+        try:
+            # Surface any error raised by the Ollama stream
+            await generation
+        except asyncio.CancelledError:
+            if ticket.cancelled:
+                return
+            raise
+        if (event := coalescer.flush()) is not None:
+            yield event
+
+        finished = time.monotonic()
+        completed = True
+        yield format_sse("done", {
+            "sources": [
                 {
-                    "role": "system",
-                    "content": SYSTEM_PROMPT + "\n".join(top_chunks),
-                },
-                {"role": "user", "content": question},
+                    "collection": result["collection"],
+                    "id": result["id"],
+                    "distance": result["distance"],
+                    "metadata": result["metadata"],
+                }
+                for result in top_results
             ],
-            stream=True
-        )
-
-        for chunk in response:
-            # print(chunk["message"]["content"])
-            yield chunk["message"]["content"]
+            "timings": {
+                "retrieval_ms": round((retrieved - started) * 1000, 1),
+                "queue_ms": round((admitted - retrieved) * 1000, 1),
+                "first_token_ms": round(((first_token or finished) - admitted) * 1000, 1),
+                "generation_ms": round((finished - admitted) * 1000, 1),
+                "total_ms": round((finished - started) * 1000, 1),
+            },
+            "retrieval": retrieval,
+        })
     except Exception as e:
         print(f"Error generating chat response: {e}")
-        yield ""
+        yield format_sse("error", {"error": str(e)})
+    finally:
+        # Cancelling the generation closes the Ollama connection, which aborts it server-side
+        if generation is not None and not generation.done():
+            generation.cancel()
+        if ticket.state in ("queued", "granted") or (ticket.state == "running" and not completed):
+            scheduler.cancel(ticket)
+        scheduler.release(ticket)
 
-# Function to combine results and pick top 7 chunks
-def combine_and_select_top_chunks(results_list, top_n=7):
+# Function to combine results and pick the top 7 results along with where they came from
+def select_top_results(results_list, collections: List[str], top_n=7):
     """
-    Combine results from multiple collections and select the top N chunks based on similarity.
+    Combine results from multiple collections and select the top N results based on similarity.
 
     Parameters:
     results_list (List[dict]): A list of results from different collections.
-    top_n (int): The number of top chunks to select. Default is 7.
+    collections (List[str]): The collection each entry of `results_list` came from.
+    top_n (int): The number of top results to select, or None for all of them. Default is 7.
 
     Returns:
-    List[str]: The top N chunks of text.
+    List[dict]: The top N results, each with its collection, id, distance, document, metadata
+    and embedding (None if it was not fetched).
     """
-    try:    
+    try:
         combined_results = []
-        for result in results_list:
-            distances = result.get("distances", [])[0]
-            documents = result.get("documents", [])[0]
-            combined_results.extend(zip(distances, documents))
-        
+        for collection_name, result in zip(collections, results_list):
+            ids = result.get("ids", [[]])[0]
+            distances = result.get("distances", [[]])[0]
+            documents = result.get("documents", [[]])[0]
+            metadatas = (result.get("metadatas") or [[None] * len(ids)])[0]
+            embeddings = result.get("embeddings")
+            embeddings = embeddings[0] if embeddings is not None else [None] * len(ids)
+            for id, distance, document, metadata, embedding in zip(ids, distances, documents, metadatas, embeddings):
+                combined_results.append({
+                    "collection": collection_name,
+                    "id": id,
+                    "distance": distance,
+                    "document": document,
+                    "metadata": metadata or {},
+                    "embedding": [float(value) for value in embedding] if embedding is not None else None,
+                })
+
         # Sort combined results by distance (similarity score)
-        combined_results.sort(key=lambda x: x[0])
-        
+        combined_results.sort(key=lambda x: x["distance"])
+
         # Select top N results
-        top_chunks = [doc for _, doc in combined_results[:top_n]]
-        return top_chunks
+        return combined_results[:top_n]
     except Exception as e:
-        print(f"Error combining and selecting top chunks: {e}")
+        print(f"Error combining and selecting top results: {e}")
         return []
\ No newline at end of file
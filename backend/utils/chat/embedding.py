@@ -1,40 +1,79 @@
 import ollama
 import json
 import os
+# Hash dependencies
+from utils.hash import generate_hash
+
+# Directory holding the saved embeddings of each uploaded file
+EMBEDDINGS_DIRECTORY = "embeddings"
+
+# Function to get where a file's embeddings are saved
+def get_embeddings_path(filename):
+    """
+    Get the path of the JSON file holding a file's saved embeddings.
+
+    Parameters:
+    filename (str): The name of the uploaded file.
+
+    Returns:
+    str: Path of the embeddings file.
+    """
+    return os.path.join(EMBEDDINGS_DIRECTORY, f"{filename}.json")
+
+# Function to fingerprint the chunks a set of embeddings was generated from
+def get_chunks_hash(modelname, chunks):
+    """
+    Get a hash identifying the model and exact chunk texts behind a set of embeddings.
+
+    Parameters:
+    modelname (str): The name of the embedding model.
+    chunks (List[str]): The chunks of text.
+
+    Returns:
+    str: The resulting hash.
+    """
+    return generate_hash(json.dumps([modelname, chunks]))
 
 # Load and save embeddings using JSON files
-def save_embeddings(filename, embeddings):
+def save_embeddings(filename, embeddings, chunks_hash):
     """
     Save embeddings to a JSON file.
 
     Parameters:
     filename (str): The name of the file to save the embeddings to.
     embeddings (List[List[float]]): The embeddings to save.
+    chunks_hash (str): Hash of the model and chunks the embeddings were generated from.
     """
     try:
-        if not os.path.exists("embeddings"):
-            os.makedirs("embeddings")
-        with open(f"embeddings/{filename}.json", "w") as f:
-            json.dump(embeddings, f)
+        if not os.path.exists(EMBEDDINGS_DIRECTORY):
+            os.makedirs(EMBEDDINGS_DIRECTORY)
+        with open(get_embeddings_path(filename), "w") as f:
+            json.dump({"chunks_hash": chunks_hash, "embeddings": embeddings}, f)
     except Exception as e:
         print(f"Error saving embeddings: {e}")
 
 
-def load_embeddings(filename):
+def load_embeddings(filename, chunks_hash):
     """
     Load embeddings from a JSON file.
 
     Parameters:
     filename (str): The name of the file to load the embeddings from.
+    chunks_hash (str): Hash of the model and chunks the embeddings must have been generated from.
 
     Returns:
-    List[List[float]]: The loaded embeddings, or False if loading fails.
+    List[List[float]]: The loaded embeddings, or False if loading fails or they were
+    generated from different chunks.
     """
     try:
-        if not os.path.exists(f"embeddings/{filename}.json"):
+        if not os.path.exists(get_embeddings_path(filename)):
+            return False
+        with open(get_embeddings_path(filename), "r") as f:
+            saved = json.load(f)
+        # Files saved before chunk hashing are plain lists and cannot be verified
+        if not isinstance(saved, dict) or saved.get("chunks_hash") != chunks_hash:
             return False
-        with open(f"embeddings/{filename}.json", "r") as f:
-            return json.load(f)
+        return saved["embeddings"]
     except Exception as e:
         print(f"Error loading embeddings: {e}")
         return False
@@ -53,13 +92,15 @@ def get_embeddings(filename, modelname, chunks):
     List[List[float]]: The embeddings for the provided chunks.
     """
     try:
-        if (embeddings := load_embeddings(filename)) is not False:
+        # Reuse saved embeddings only if they were generated from these exact chunks
+        chunks_hash = get_chunks_hash(modelname, chunks)
+        if (embeddings := load_embeddings(filename, chunks_hash)) is not False:
             return embeddings
         embeddings = [
             ollama.embeddings(model=modelname, prompt=chunk)["embedding"]
             for chunk in chunks
         ]
-        save_embeddings(filename, embeddings)
+        save_embeddings(filename, embeddings, chunks_hash)
         return embeddings
     except Exception as e:
         print(f"Error getting embeddings: {e}")
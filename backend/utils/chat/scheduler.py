@@ -0,0 +1,241 @@
+import os
+import asyncio
+import threading
+import uuid
+from collections import OrderedDict, deque
+
+# Maximum number of llama3 generations running at once
+MAX_CONCURRENT_GENERATIONS = int(os.getenv("MAX_CONCURRENT_GENERATIONS", "2"))
+
+
+class GenerationTicket:
+    """
+    A request's place in the generation queue.
+
+    Attributes:
+        request_id (str): Unique id of the request, returned to the client.
+        user_id (str): The user the request belongs to, used for fairness.
+        state (str): One of "queued", "granted", "running", "done" or "cancelled".
+    """
+    def __init__(self, user_id):
+        self.request_id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.state = "queued"
+        self._waiters = []  # (loop, asyncio.Event) pairs woken when the state changes
+        self._task = None  # The running generation, aborted on cancel
+        self._loop = None
+
+    @property
+    def cancelled(self):
+        return self.state == "cancelled"
+
+
+class GenerationScheduler:
+    """
+    Bounded admission control for LLM generation.
+
+    At most `max_concurrent` tickets hold a generation slot. Waiting tickets are
+    kept in one FIFO per user and slots are handed out round-robin across users,
+    so a single user submitting many questions cannot starve everyone else.
+    """
+    def __init__(self, max_concurrent=MAX_CONCURRENT_GENERATIONS):
+        self.max_concurrent = max(1, int(max_concurrent))
+        self._lock = threading.Lock()
+        self._queues = OrderedDict()  # user_id -> deque of tickets, in round-robin order
+        self._tickets = {}
+        self._active = 0
+
+    def enqueue(self, ticket):
+        """
+        Add a request to the queue, granting it a slot straight away if one is free.
+
+        Parameters:
+        ticket (GenerationTicket): The ticket tracking the request.
+
+        Returns:
+        GenerationTicket: The same ticket, now queued.
+        """
+        with self._lock:
+            self._tickets[ticket.request_id] = ticket
+            self._queues.setdefault(ticket.user_id, deque()).append(ticket)
+            self._dispatch()
+        return ticket
+
+    def get_ticket(self, request_id):
+        """
+        Look up a ticket by its request id.
+
+        Returns:
+        GenerationTicket: The ticket, or None if it is unknown or finished.
+        """
+        with self._lock:
+            return self._tickets.get(request_id)
+
+    def position(self, ticket):
+        """
+        Get the 1-based position of a ticket in the queue.
+
+        Parameters:
+        ticket (GenerationTicket): The ticket to locate.
+
+        Returns:
+        int: The position in the queue, or 0 if the ticket is no longer waiting.
+        """
+        with self._lock:
+            if ticket.state != "queued":
+                return 0
+            for index, queued in enumerate(self._round_robin_order(), start=1):
+                if queued is ticket:
+                    return index
+            return 0
+
+    async def wait(self, ticket, timeout=None):
+        """
+        Wait on the event loop, without holding a thread, until the ticket is
+        granted a slot or cancelled.
+
+        Parameters:
+        ticket (GenerationTicket): The ticket to wait on.
+        timeout (float): Maximum seconds to wait, or None to wait indefinitely.
+
+        Returns:
+        bool: True if the ticket may start generating.
+        """
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            if ticket.state == "queued":
+                ticket._waiters.append(waiter)
+            else:
+                waiter[1].set()
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._lock:
+                if waiter in ticket._waiters:
+                    ticket._waiters.remove(waiter)
+
+        with self._lock:
+            if ticket.state == "granted":
+                ticket.state = "running"
+            return ticket.state == "running"
+
+    def attach(self, ticket, task):
+        """
+        Attach the asyncio task running a ticket's generation, so cancelling the
+        ticket aborts it straight away rather than at the next token.
+
+        Parameters:
+        ticket (GenerationTicket): The running ticket.
+        task (asyncio.Task): The task streaming the generation.
+        """
+        with self._lock:
+            ticket._task = task
+            ticket._loop = task.get_loop()
+            if ticket.cancelled:
+                ticket._loop.call_soon_threadsafe(task.cancel)
+
+    def cancel(self, ticket):
+        """
+        Cancel a ticket. Queued tickets leave the queue, and granted tickets that
+        never started give their slot back. A running ticket has its generation
+        task cancelled, which closes the Ollama stream; its owner then releases it.
+
+        Parameters:
+        ticket (GenerationTicket): The ticket to cancel.
+        """
+        with self._lock:
+            state = ticket.state
+            if state in ("done", "cancelled"):
+                return
+            ticket.state = "cancelled"
+            if state == "queued":
+                user_queue = self._queues.get(ticket.user_id)
+                if user_queue is not None and ticket in user_queue:
+                    user_queue.remove(ticket)
+                    if not user_queue:
+                        del self._queues[ticket.user_id]
+                self._tickets.pop(ticket.request_id, None)
+            elif state == "granted":
+                self._finish(ticket)
+            elif state == "running" and ticket._task is not None:
+                ticket._loop.call_soon_threadsafe(ticket._task.cancel)
+            self._notify(ticket)
+
+    def release(self, ticket):
+        """
+        Release a ticket's generation slot once generation has ended.
+
+        Parameters:
+        ticket (GenerationTicket): The ticket to release.
+        """
+        with self._lock:
+            if ticket.state in ("granted", "running") or (ticket.cancelled and ticket.request_id in self._tickets):
+                if not ticket.cancelled:
+                    ticket.state = "done"
+                self._finish(ticket)
+
+    def stats(self):
+        """
+        Returns:
+        dict: Number of running and queued generations.
+        """
+        with self._lock:
+            return {
+                "active": self._active,
+                "queued": sum(len(user_queue) for user_queue in self._queues.values()),
+                "max_concurrent": self.max_concurrent,
+            }
+
+    def _finish(self, ticket):
+        # Caller holds the lock and the ticket holds a slot
+        self._tickets.pop(ticket.request_id, None)
+        self._active -= 1
+        self._dispatch()
+
+    def _round_robin_order(self):
+        # Caller holds the lock
+        pending = [list(user_queue) for user_queue in self._queues.values()]
+        order = []
+        depth = 0
+        while any(depth < len(tickets) for tickets in pending):
+            order.extend(tickets[depth] for tickets in pending if depth < len(tickets))
+            depth += 1
+        return order
+
+    def _dispatch(self):
+        # Caller holds the lock
+        while self._active < self.max_concurrent and self._queues:
+            user_id, user_queue = next(iter(self._queues.items()))
+            ticket = user_queue.popleft()
+            # Rotate this user to the back so other users go next
+            del self._queues[user_id]
+            if user_queue:
+                self._queues[user_id] = user_queue
+            ticket.state = "granted"
+            self._active += 1
+            self._notify(ticket)
+
+    def _notify(self, ticket):
+        # Caller holds the lock; wakes waiters from whichever thread changed the state
+        for loop, event in ticket._waiters:
+            loop.call_soon_threadsafe(event.set)
+
+
+_generation_scheduler = None
+_generation_scheduler_lock = threading.Lock()
+
+
+def get_generation_scheduler():
+    """
+    Get the process-wide generation scheduler, creating it on first use.
+
+    Returns:
+    GenerationScheduler: The shared scheduler instance.
+    """
+    global _generation_scheduler
+    with _generation_scheduler_lock:
+        if _generation_scheduler is None:
+            _generation_scheduler = GenerationScheduler()
+        return _generation_scheduler
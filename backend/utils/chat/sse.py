@@ -0,0 +1,63 @@
+import json
+import os
+import time
+
+# How long tokens are buffered before being flushed as one event
+TOKEN_FLUSH_INTERVAL_MS = float(os.getenv("SSE_TOKEN_FLUSH_INTERVAL_MS", "50"))
+
+# Function to frame a single server-sent event
+def format_sse(event, data):
+    """
+    Formats a server-sent event.
+
+    Args:
+        event (str): The event name.
+        data (Any): JSON-serialisable event payload.
+
+    Returns:
+        str: The framed event, terminated by a blank line.
+    """
+    payload = json.dumps(data, ensure_ascii=False)
+    # A JSON payload never contains raw newlines, so a single data line suffices
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+class TokenCoalescer:
+    """
+    Buffers streamed tokens and releases them in time-windowed batches, so the
+    client receives one `token` event per window rather than one write per token.
+    """
+    def __init__(self, interval_ms=TOKEN_FLUSH_INTERVAL_MS):
+        self.interval = max(0.0, float(interval_ms)) / 1000.0
+        self._buffer = []
+        self._last_flush = time.monotonic()
+
+    def add(self, token):
+        """
+        Buffer a token.
+
+        Args:
+            token (str): The token text.
+
+        Returns:
+            str: A framed `token` event if the window has elapsed, otherwise None.
+        """
+        if token:
+            self._buffer.append(token)
+        if self._buffer and time.monotonic() - self._last_flush >= self.interval:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """
+        Release whatever is buffered.
+
+        Returns:
+            str: A framed `token` event, or None if nothing is buffered.
+        """
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return None
+        text = "".join(self._buffer)
+        self._buffer = []
+        return format_sse("token", {"text": text})
@@ -0,0 +1,209 @@
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Minimum cosine similarity to the last fully retrieved question for the working set to be reused
+REUSE_SIMILARITY = float(os.getenv("WORKING_SET_REUSE_SIMILARITY", "0.8"))
+# Most recently retrieved chunks kept per conversation
+MAX_CHUNKS = int(os.getenv("WORKING_SET_MAX_CHUNKS", "40"))
+# Conversations kept at once, least recently used are evicted first
+MAX_CONVERSATIONS = int(os.getenv("WORKING_SET_MAX_CONVERSATIONS", "256"))
+# Seconds after which an idle conversation's working set is dropped
+TTL_SECONDS = float(os.getenv("WORKING_SET_TTL_SECONDS", "1800"))
+
+
+def cosine_distance(a, b):
+    """
+    Cosine distance between two vectors, matching ChromaDB's `cosine` space.
+
+    Args:
+        a (List[float]): First vector.
+        b (List[float]): Second vector.
+
+    Returns:
+        float: 1 minus the cosine similarity.
+    """
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return 1.0 - (dot / norm if norm else 0.0)
+
+
+class _WorkingSet:
+    """
+    The chunks recently retrieved for one conversation.
+
+    Attributes:
+        scope (tuple): The collections and filter the chunks were retrieved under.
+        anchor (List[float]): Embedding of the last question that triggered a full retrieval.
+        boundary (float): Largest distance among that retrieval's results, used as a
+            heuristic threshold: a rescored answer reaching past it is treated as drift.
+        chunks (OrderedDict): (collection, id) -> result, oldest first.
+        updated (float): When the working set was last used.
+    """
+    def __init__(self, scope):
+        self.scope = scope
+        self.anchor = None
+        self.boundary = 0.0
+        self.chunks = OrderedDict()
+        self.updated = time.monotonic()
+
+
+class ConversationWorkingSets:
+    """
+    Keeps a per-conversation working set of recently retrieved chunks with their
+    embeddings, so follow-up questions on the same passages can be answered by
+    rescoring those chunks in-process instead of querying ChromaDB again.
+    """
+    def __init__(self, reuse_similarity=REUSE_SIMILARITY, max_chunks=MAX_CHUNKS,
+                 max_conversations=MAX_CONVERSATIONS, ttl_seconds=TTL_SECONDS):
+        self.reuse_similarity = reuse_similarity
+        self.max_chunks = max_chunks
+        self.max_conversations = max_conversations
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._sets = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._drifts = 0
+
+    @staticmethod
+    def _scope(collections, where):
+        return (tuple(collections), json.dumps(where, sort_keys=True) if where else None)
+
+    def lookup(self, conversation_id, collections, where, embedding, top_n=7):
+        """
+        Rescore a conversation's working set against a new question.
+
+        Parameters:
+        conversation_id (str): The conversation the question belongs to.
+        collections (List[str]): The collections being searched.
+        where (dict): The metadata filter in use, if any.
+        embedding (List[float]): The new question's embedding.
+        top_n (int): The number of results to return.
+
+        Returns:
+        List[dict]: The top N results rescored for the new question, or None if the
+        question drifted away from the working set and needs a full retrieval.
+        """
+        with self._lock:
+            self._evict_expired()
+            working_set = self._sets.get(conversation_id)
+            if working_set is None or working_set.scope != self._scope(collections, where) or not working_set.chunks:
+                self._misses += 1
+                return None
+            if 1.0 - cosine_distance(embedding, working_set.anchor) < self.reuse_similarity:
+                self._misses += 1
+                self._drifts += 1
+                return None
+
+            rescored = sorted(
+                ({**chunk, "distance": cosine_distance(embedding, chunk["embedding"])}
+                 for chunk in working_set.chunks.values()),
+                key=lambda chunk: chunk["distance"],
+            )[:top_n]
+            # Heuristic: once the rescored results reach past the last retrieval's furthest
+            # result, the question has likely moved on, so fall back to a full retrieval
+            if rescored[-1]["distance"] > working_set.boundary:
+                self._misses += 1
+                self._drifts += 1
+                return None
+
+            self._hits += 1
+            working_set.updated = time.monotonic()
+            self._sets.move_to_end(conversation_id)
+            return rescored
+
+    def store(self, conversation_id, collections, where, embedding, results):
+        """
+        Record the results of a full retrieval in a conversation's working set.
+
+        Parameters:
+        conversation_id (str): The conversation the question belongs to.
+        collections (List[str]): The collections that were searched.
+        where (dict): The metadata filter in use, if any.
+        embedding (List[float]): The question's embedding.
+        results (List[dict]): The retrieved results, each with its embedding.
+        """
+        results = [result for result in results if result.get("embedding") is not None]
+        if not results:
+            return
+        with self._lock:
+            scope = self._scope(collections, where)
+            working_set = self._sets.get(conversation_id)
+            if working_set is None or working_set.scope != scope:
+                working_set = _WorkingSet(scope)
+                self._sets[conversation_id] = working_set
+
+            working_set.anchor = list(embedding)
+            working_set.boundary = max(result["distance"] for result in results)
+            for result in results:
+                key = (result["collection"], result["id"])
+                working_set.chunks.pop(key, None)
+                working_set.chunks[key] = result
+            while len(working_set.chunks) > self.max_chunks:
+                working_set.chunks.popitem(last=False)
+
+            working_set.updated = time.monotonic()
+            self._sets.move_to_end(conversation_id)
+            while len(self._sets) > self.max_conversations:
+                self._sets.popitem(last=False)
+
+    def invalidate(self, collection_name):
+        """
+        Drop every working set searching a collection, e.g. after its file is
+        deleted, re-processed or its collection rebuilt.
+
+        Parameters:
+        collection_name (str): The collection whose chunks are no longer valid.
+        """
+        with self._lock:
+            for conversation_id in [
+                conversation_id for conversation_id, working_set in self._sets.items()
+                if collection_name in working_set.scope[0]
+            ]:
+                del self._sets[conversation_id]
+
+    def stats(self):
+        """
+        Returns:
+        dict: Working set hits, misses, how many misses were topic drift, and the reuse rate.
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "drifts": self._drifts,
+                "reuse_rate": self._hits / lookups if lookups else 0.0,
+                "conversations": len(self._sets),
+            }
+
+    def _evict_expired(self):
+        # Caller holds the lock
+        cutoff = time.monotonic() - self.ttl_seconds
+        while self._sets:
+            conversation_id, working_set = next(iter(self._sets.items()))
+            if working_set.updated >= cutoff:
+                break
+            del self._sets[conversation_id]
+
+
+_working_sets = None
+_working_sets_lock = threading.Lock()
+
+
+def get_working_sets():
+    """
+    Get the process-wide conversation working sets, creating them on first use.
+
+    Returns:
+    ConversationWorkingSets: The shared instance.
+    """
+    global _working_sets
+    with _working_sets_lock:
+        if _working_sets is None:
+            _working_sets = ConversationWorkingSets()
+        return _working_sets
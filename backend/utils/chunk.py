@@ -1,30 +1,57 @@
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import Document
 
-# Function to chunk text into smaller pieces
-def chunk_text(text, chunk_size=1000, chunk_overlap=50):
+# Default chunk size and overlap, in characters
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 50
+
+# Function to chunk documents while keeping their metadata
+def chunk_documents(documents, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
     """
-    Splits text into smaller chunks for better processing.
+    Splits documents into smaller chunks, carrying each document's metadata
+    (page, sheet, row range, section) over to every chunk cut from it.
 
     Args:
-        text (str): The text to be split.
+        documents (List[Document]): The documents to be split.
         chunk_size (int): The size of each chunk.
         chunk_overlap (int): The overlap between chunks.
 
     Returns:
-        List[str]: List of text chunks.
+        List[Document]: List of chunks with their source document's metadata.
     """
     try:
         splitter = RecursiveCharacterTextSplitter(
             chunk_size=chunk_size,
             chunk_overlap=chunk_overlap
         )
-        doc_output = splitter.split_documents([Document(page_content=text)])
-        # print(doc_output)
-        # Convert the Document objects to a list of strings
-        result = [doc.page_content for doc in doc_output]
-        # print(result)
-        return result
+        return splitter.split_documents(documents)
     except Exception as e:
-        print(f"Error chunking text: {e}")
-        return []
\ No newline at end of file
+        print(f"Error chunking documents: {e}")
+        return []
+
+# Function to group consecutive table rows into chunk-sized blocks
+def group_rows(rows, max_chars=CHUNK_SIZE, header=""):
+    """
+    Groups consecutive rows into blocks of at most `max_chars` characters, so each
+    block becomes a single chunk and its row range stays exact. A row longer than
+    `max_chars` gets a block of its own.
+
+    Args:
+        rows (List[str]): The rendered rows, in order.
+        max_chars (int): Largest block size, including the header.
+        header (str): Optional line repeated at the top of every block.
+
+    Returns:
+        List[tuple]: (first row index, last row index, text) for each block, with 0-based indices.
+    """
+    blocks = []
+    start, lines, size = 0, [], len(header)
+    for index, row in enumerate(rows):
+        if lines and size + 1 + len(row) > max_chars:
+            blocks.append((start, index - 1, "\n".join(([header] if header else []) + lines)))
+            start, lines, size = index, [], len(header)
+        lines.append(row)
+        size += (1 if size else 0) + len(row)
+    if lines:
+        blocks.append((start, len(rows) - 1, "\n".join(([header] if header else []) + lines)))
+    return blocks
@@ -1,21 +1,27 @@
 from langchain_community.document_loaders.csv_loader import CSVLoader
-    
-# Function to extract text from a CSV file
-def extract_text_from_csv(csv_path):
+from langchain.schema import Document
+from utils.chunk import CHUNK_SIZE, group_rows
+
+# Function to load a CSV file as documents of consecutive rows
+def load_documents_from_csv(csv_path, max_chars=CHUNK_SIZE):
     """
-    Extracts text from a CSV file.
+    Loads a CSV file as documents of consecutive rows, each small enough to be
+    stored as a single chunk so its row range is exact.
 
     Args:
         csv_path (str): Path to the CSV file.
+        max_chars (int): Largest document size in characters.
 
     Returns:
-        str: Extracted text from the CSV file.
+        List[Document]: Documents with the 1-based `row_start` and `row_end` in their metadata.
     """
     try:
         loader = CSVLoader(file_path=csv_path)
-        data = loader.load()
-        text = "\n".join([str(record) for record in data])
-        return text
+        records = loader.load()
+        return [
+            Document(page_content=text, metadata={"row_start": start + 1, "row_end": end + 1})
+            for start, end, text in group_rows([record.page_content for record in records], max_chars)
+        ]
     except Exception as e:
-        print(f"Error extracting text from CSV: {e}")
-        return ""
+        print(f"Error loading documents from CSV: {e}")
+        return []
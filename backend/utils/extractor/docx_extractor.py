@@ -1,20 +1,36 @@
 import docx
+from langchain.schema import Document
 
-# Function to extract text from a DOCX file
-def extract_text_from_docx(docx_path):
+# Function to load a DOCX file as one document per section
+def load_documents_from_docx(docx_path):
     """
-    Extracts text from a DOCX file.
+    Loads a DOCX file as one document per section, starting a new section at each heading.
 
     Args:
         docx_path (str): Path to the DOCX file.
 
     Returns:
-        str: Extracted text from the DOCX file.
+        List[Document]: One document per section, with the section heading in its metadata.
     """
     try:
         doc = docx.Document(docx_path)
-        text = "\n".join([para.text for para in doc.paragraphs])
-        return text
+        sections = []
+        heading, paragraphs = None, []
+        for para in doc.paragraphs:
+            style_name = para.style.name if para.style is not None else ""
+            if style_name.startswith("Heading") or style_name == "Title":
+                if any(text.strip() for text in paragraphs):
+                    sections.append((heading, paragraphs))
+                heading, paragraphs = para.text.strip() or heading, [para.text]
+            else:
+                paragraphs.append(para.text)
+        if any(text.strip() for text in paragraphs):
+            sections.append((heading, paragraphs))
+
+        return [
+            Document(page_content="\n".join(paragraphs), metadata={"section": heading} if heading else {})
+            for heading, paragraphs in sections
+        ]
     except Exception as e:
-        print(f"Error extracting text from DOCX: {e}")
-        return ""
\ No newline at end of file
+        print(f"Error loading documents from DOCX: {e}")
+        return []
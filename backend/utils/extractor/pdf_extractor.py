@@ -1,21 +1,24 @@
 from langchain_community.document_loaders import PyPDFLoader
+from langchain.schema import Document
 
-# Function to extract text from a PDF file
-def extract_text_from_pdf(pdf_path):
+# Function to load a PDF file as one document per page
+def load_documents_from_pdf(pdf_path):
     """
-    Extracts text from a PDF file.
+    Loads a PDF file as one document per page.
 
     Args:
         pdf_path (str): Path to the PDF file.
 
     Returns:
-        str: Extracted text from the PDF file.
+        List[Document]: One document per page, with the 1-based page number in its metadata.
     """
     try:
         loader = PyPDFLoader(pdf_path)
-        pages = loader.load_and_split()
-        text = "\n".join(page.page_content for page in pages)
-        return text
+        pages = loader.load()
+        return [
+            Document(page_content=page.page_content, metadata={"page": page.metadata.get("page", index) + 1})
+            for index, page in enumerate(pages)
+        ]
     except Exception as e:
-        print(f"Error extracting text from PDF: {e}")
-        return ""
\ No newline at end of file
+        print(f"Error loading documents from PDF: {e}")
+        return []
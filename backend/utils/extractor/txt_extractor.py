@@ -1,21 +1,21 @@
 from langchain_community.document_loaders import TextLoader
+from langchain.schema import Document
 
-# Function to extract text from a TXT file
-def extract_text_from_txt(txt_path):
+# Function to load a TXT file as a single document
+def load_documents_from_txt(txt_path):
     """
-    Extracts text from a TXT file.
+    Loads a TXT file as a single document. Plain text carries no structure to keep.
 
     Args:
         txt_path (str): Path to the TXT file.
 
     Returns:
-        str: Extracted text from the TXT file.
+        List[Document]: A single document holding the file's text.
     """
     try:
         loader = TextLoader(txt_path)
-        documents = loader.load()
-        text = "\n".join(doc.page_content for doc in documents)
-        return text
+        text = "\n".join(doc.page_content for doc in loader.load())
+        return [Document(page_content=text)] if text else []
     except Exception as e:
-        print(f"Error extracting text from TXT: {e}")
-        return ""
\ No newline at end of file
+        print(f"Error loading documents from TXT: {e}")
+        return []
@@ -1,20 +1,35 @@
 import pandas as pd
+from langchain.schema import Document
+from utils.chunk import CHUNK_SIZE, group_rows
 
-# Function to extract text from an XLSX file
-def extract_text_from_xlsx(xlsx_path):
+# Function to load an XLSX file as documents of consecutive rows per sheet
+def load_documents_from_xlsx(xlsx_path, max_chars=CHUNK_SIZE):
     """
-    Extracts text from an XLSX file.
+    Loads every sheet of an XLSX file as documents of consecutive rows, each small
+    enough to be stored as a single chunk so its row range is exact.
 
     Args:
         xlsx_path (str): Path to the XLSX file.
+        max_chars (int): Largest document size in characters.
 
     Returns:
-        str: Extracted text from the XLSX file.
+        List[Document]: Documents with the `sheet` name and 1-based `row_start` and `row_end` in their metadata.
     """
     try:
-        df = pd.read_excel(xlsx_path)
-        text = df.to_string(index=False)
-        return text
+        sheets = pd.read_excel(xlsx_path, sheet_name=None)
+        documents = []
+        for sheet_name, df in sheets.items():
+            if df.empty:
+                continue
+            # One line per row, as `to_string` escapes newlines inside cells
+            header, *rows = df.to_string(index=False).split("\n")
+            # Repeat the header in every block so each chunk stays self-describing
+            for start, end, text in group_rows(rows, max_chars, header=header):
+                documents.append(Document(
+                    page_content=text,
+                    metadata={"sheet": str(sheet_name), "row_start": start + 1, "row_end": end + 1},
+                ))
+        return documents
     except Exception as e:
-        print(f"Error extracting text from XLSX: {e}")
-        return ""
\ No newline at end of file
+        print(f"Error loading documents from XLSX: {e}")
+        return []
@@ -20,6 +20,20 @@ def add_to_hash_map(file_name):
         print(f"Error adding to hash map: {e}")
 
 
+# Remove file metadata from the hash map
+def remove_from_hash_map(file_name):
+    """
+    Removes a file's metadata from the hash map, if present.
+
+    Args:
+        file_name (str): The name of the file.
+    """
+    try:
+        file_hash_map.pop(str(file_name), None)
+    except Exception as e:
+        print(f"Error removing from hash map: {e}")
+
+
 # Generate a hash from an input string
 def generate_hash(input_string):
     """
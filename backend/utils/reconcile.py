@@ -0,0 +1,130 @@
+import os
+import chromadb
+# Hash dependencies
+from utils.hash import add_to_hash_map, get_file_hash_map, remove_from_hash_map
+# Embeddding dependencies
+from utils.chat.embedding import EMBEDDINGS_DIRECTORY
+# Working set dependencies
+from utils.chat.working_set import get_working_sets
+# Vector store depenedencies
+from utils.vector_store.vector_store import delete_from_chromadb, get_collection_name, is_managed_collection, is_rebuild_collection
+
+UPLOAD_DIRECTORY = "uploads"
+
+# Bytes per stored vector component (float32)
+BYTES_PER_DIMENSION = 4
+
+# Function to list the files currently in the uploads directory
+def list_uploaded_files():
+    """
+    Lists the files in the uploads directory.
+
+    Returns:
+        set: The uploaded file names.
+    """
+    if not os.path.isdir(UPLOAD_DIRECTORY):
+        return set()
+    return {
+        name for name in os.listdir(UPLOAD_DIRECTORY)
+        if os.path.isfile(os.path.join(UPLOAD_DIRECTORY, name))
+    }
+
+# Function to cross-check uploads, saved embeddings, ChromaDB and the file registry
+def reconcile_storage(dry_run=False, include_unmanaged=False):
+    """
+    Reconciles stored data against the uploads directory, which is treated as the
+    source of truth. ChromaDB collections created by this app and saved embeddings
+    files with no matching upload are deleted, registry entries for missing uploads are dropped,
+    and uploads that have a collection but are missing from the in-memory registry
+    (e.g. after a restart) are registered again.
+
+    Orphaned collections without the managed flag, such as ones left by earlier
+    versions of this app or belonging to other tools, are listed under
+    `unmanaged_collections` and only deleted when `include_unmanaged` is set.
+
+    Args:
+        dry_run (bool): Only report what would be changed.
+        include_unmanaged (bool): Also delete orphaned collections without the managed flag.
+
+    Returns:
+        dict: A report of the orphans found and the vectors and bytes reclaimed.
+    """
+    uploaded_files = list_uploaded_files()
+    expected_collections = {get_collection_name(name) for name in uploaded_files}
+    report = {
+        "dry_run": dry_run,
+        "orphaned_collections": [],
+        "unmanaged_collections": [],
+        "orphaned_embedding_files": [],
+        "stale_registry_entries": [],
+        "registered_files": [],
+        "vectors_reclaimed": 0,
+        "embedding_file_bytes_reclaimed": 0,
+        "vector_bytes_reclaimed": 0,
+        "bytes_reclaimed": 0,
+    }
+
+    # Orphaned ChromaDB collections
+    existing_collections = set()
+    try:
+        client = chromadb.HttpClient(host='localhost', port=8001)  # ChromaDB port
+        for collection in client.list_collections():
+            # Older clients return Collection objects, newer ones return names
+            existing_collections.add(getattr(collection, "name", collection))
+        for collection_name in sorted(existing_collections - expected_collections):
+            # In-flight or backup copies made by swap_in_collection are left alone
+            if is_rebuild_collection(collection_name):
+                continue
+            collection = client.get_collection(name=collection_name)
+            # Collections without the flag may belong to other tools, so they are only deleted on request
+            if not is_managed_collection(collection.metadata):
+                report["unmanaged_collections"].append(collection_name)
+                if not include_unmanaged:
+                    continue
+            vectors = collection.count()
+            sample = collection.peek(limit=1).get("embeddings")
+            dimensions = len(sample[0]) if sample is not None and len(sample) else 0
+            if not dry_run:
+                if not delete_from_chromadb(collection_name):
+                    continue
+                get_working_sets().invalidate(collection_name)
+            report["orphaned_collections"].append(collection_name)
+            report["vectors_reclaimed"] += vectors
+            # Estimated from the raw vectors; index overhead is not counted
+            report["vector_bytes_reclaimed"] += vectors * dimensions * BYTES_PER_DIMENSION
+    except Exception as e:
+        print(f"Error reconciling ChromaDB collections: {e}")
+
+    # Orphaned saved embeddings files
+    if os.path.isdir(EMBEDDINGS_DIRECTORY):
+        for name in sorted(os.listdir(EMBEDDINGS_DIRECTORY)):
+            path = os.path.join(EMBEDDINGS_DIRECTORY, name)
+            if not name.endswith(".json") or not os.path.isfile(path):
+                continue
+            if name[:-len(".json")] in uploaded_files:
+                continue
+            try:
+                size = os.path.getsize(path)
+                if not dry_run:
+                    os.remove(path)
+                report["orphaned_embedding_files"].append(name)
+                report["embedding_file_bytes_reclaimed"] += size
+            except OSError as e:
+                print(f"Error removing embeddings file {path}: {e}")
+
+    # Registry entries for files that no longer exist, and processed uploads missing from it
+    file_hash_map = get_file_hash_map()
+    for file_name in sorted(set(file_hash_map) - uploaded_files):
+        report["stale_registry_entries"].append(file_name)
+        if not dry_run:
+            remove_from_hash_map(file_name)
+    for file_name in sorted(uploaded_files - set(file_hash_map)):
+        if get_collection_name(file_name) in existing_collections:
+            report["registered_files"].append(file_name)
+            if not dry_run:
+                add_to_hash_map(file_name)
+
+    report["bytes_reclaimed"] = report["embedding_file_bytes_reclaimed"] + report["vector_bytes_reclaimed"]
+    print(f"Storage reconciliation {'(dry run) ' if dry_run else ''}reclaimed "
+          f"{report['vectors_reclaimed']} vectors and {report['bytes_reclaimed']} bytes")
+    return report
\ No newline at end of file
@@ -0,0 +1,243 @@
+"""
+Calibrates HNSW settings against the stored embeddings.
+
+Measures recall@k of each (M, construction_ef, search_ef) combination against
+exact brute-force search, together with query latency, and recommends the
+settings with the best recall whose p95 latency meets the target.
+
+By default every file's embeddings are merged into one index built in-process,
+so the latency measured is the index alone, without ChromaDB's HTTP round trip,
+and the recommendation is a global default (HNSW_* environment variables).
+`--file` calibrates each given file on its own, as the app queries one collection
+per file, and prints a recommendation to apply with `/tune-collection/`.
+`--server` builds the throwaway indexes on the running ChromaDB server, so the
+latency includes the round trip the app sees.
+
+Run from the `backend` directory:
+
+    python -m utils.vector_store.calibrate --target-p95-ms 10
+    python -m utils.vector_store.calibrate --server --file report.pdf --file data.xlsx
+"""
+import argparse
+import glob
+import json
+import os
+import time
+import uuid
+
+import numpy as np
+import chromadb
+
+# Embeddding dependencies
+from utils.chat.embedding import EMBEDDINGS_DIRECTORY
+# Vector store depenedencies
+from utils.vector_store.vector_store import ADD_BATCH_SIZE
+
+# Function to load saved embeddings into one matrix
+def load_stored_embeddings(directory=EMBEDDINGS_DIRECTORY, paths=None):
+    """
+    Loads saved embeddings files into a single matrix.
+
+    Args:
+        directory (str): Directory holding the `<file>.json` embeddings.
+        paths (List[str]): Specific embeddings files to load instead of the whole directory.
+
+    Returns:
+        np.ndarray: One row per stored embedding.
+    """
+    vectors = []
+    for path in paths if paths is not None else sorted(glob.glob(os.path.join(directory, "*.json"))):
+        try:
+            with open(path, "r") as f:
+                saved = json.load(f)
+            # Current files hold the vectors under "embeddings", older ones are plain lists
+            embeddings = saved.get("embeddings", []) if isinstance(saved, dict) else saved
+            vectors.extend(embedding for embedding in embeddings if embedding)
+        except Exception as e:
+            print(f"Error loading embeddings from {path}: {e}")
+    return np.asarray(vectors, dtype=np.float32)
+
+# Function to compute exact nearest neighbours by cosine distance
+def exact_top_k(index_vectors, query_vectors, k):
+    """
+    Finds the exact top-k neighbours of each query by cosine similarity.
+
+    Args:
+        index_vectors (np.ndarray): The searched vectors.
+        query_vectors (np.ndarray): The query vectors.
+        k (int): Number of neighbours.
+
+    Returns:
+        np.ndarray: Row indices of the k nearest index vectors for each query.
+    """
+    def normalize(matrix):
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    similarities = normalize(query_vectors) @ normalize(index_vectors).T
+    return np.argsort(-similarities, axis=1)[:, :k]
+
+# Function to measure one HNSW configuration
+def measure_configuration(client, index_vectors, query_vectors, exact, k, m, construction_ef, search_ef):
+    """
+    Builds a throwaway collection with the given settings and measures it.
+
+    Args:
+        client (chromadb.Client): An in-process ChromaDB client.
+        index_vectors (np.ndarray): The vectors to index.
+        query_vectors (np.ndarray): The held-out query vectors.
+        exact (np.ndarray): Exact top-k indices for each query.
+        k (int): Number of neighbours.
+        m (int): HNSW `M`.
+        construction_ef (int): HNSW `construction_ef`.
+        search_ef (int): HNSW `search_ef`.
+
+    Returns:
+        dict: The settings with their recall@k, p50/p95 latency and build time.
+    """
+    name = f"calibrate_{uuid.uuid4().hex[:8]}"
+    collection = client.create_collection(name=name, metadata={
+        "hnsw:space": "cosine",
+        "hnsw:M": m,
+        "hnsw:construction_ef": construction_ef,
+        "hnsw:search_ef": search_ef,
+    })
+    try:
+        started = time.perf_counter()
+        for start in range(0, len(index_vectors), ADD_BATCH_SIZE):
+            batch = index_vectors[start:start + ADD_BATCH_SIZE]
+            collection.add(
+                ids=[str(i) for i in range(start, start + len(batch))],
+                embeddings=batch.tolist(),
+            )
+        build_ms = (time.perf_counter() - started) * 1000
+
+        latencies, recalls = [], []
+        for query, expected in zip(query_vectors, exact):
+            started = time.perf_counter()
+            result = collection.query(query_embeddings=[query.tolist()], n_results=k, include=[])
+            latencies.append((time.perf_counter() - started) * 1000)
+            found = {int(id) for id in result["ids"][0]}
+            recalls.append(len(found & set(expected.tolist())) / k)
+
+        return {
+            "m": m,
+            "construction_ef": construction_ef,
+            "search_ef": search_ef,
+            "recall": float(np.mean(recalls)),
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+            "build_ms": build_ms,
+        }
+    finally:
+        client.delete_collection(name)
+
+# Function to pick the best configuration for a latency target
+def recommend(results, target_p95_ms):
+    """
+    Picks the configuration with the best recall whose p95 latency meets the target,
+    preferring lower latency on ties. Falls back to the fastest configuration.
+
+    Args:
+        results (List[dict]): Measured configurations.
+        target_p95_ms (float): Target p95 query latency in milliseconds.
+
+    Returns:
+        dict: The recommended configuration, or None if nothing was measured.
+    """
+    if not results:
+        return None
+    within_target = [result for result in results if result["p95_ms"] <= target_p95_ms]
+    if within_target:
+        return max(within_target, key=lambda result: (result["recall"], -result["p95_ms"]))
+    return min(results, key=lambda result: result["p95_ms"])
+
+def parse_int_list(value):
+    return [int(item) for item in value.split(",") if item.strip()]
+
+# Function to measure every configuration on one set of vectors
+def calibrate(client, vectors, args):
+    """
+    Measures every configuration of the grid on a set of stored vectors.
+
+    Args:
+        client (chromadb.Client): The client the throwaway collections are built with.
+        vectors (np.ndarray): The stored vectors.
+        args (argparse.Namespace): The parsed command-line options.
+
+    Returns:
+        List[dict]: The measured configurations, or an empty list if there are too few vectors.
+    """
+    if len(vectors) <= args.k:
+        print(f"Need more than {args.k} stored embeddings, found {len(vectors)}")
+        return []
+
+    # Hold some vectors out as queries so they cannot trivially find themselves
+    rng = np.random.default_rng(args.seed)
+    order = rng.permutation(len(vectors))
+    n_queries = min(args.queries, len(vectors) - args.k)
+    query_vectors, index_vectors = vectors[order[:n_queries]], vectors[order[n_queries:]]
+    exact = exact_top_k(index_vectors, query_vectors, args.k)
+    print(f"Calibrating on {len(index_vectors)} vectors with {n_queries} queries, k={args.k}")
+
+    results = []
+    print(f"{'M':>4} {'c_ef':>5} {'s_ef':>5} {'recall':>7} {'p50 ms':>7} {'p95 ms':>7} {'build ms':>9}")
+    for m in args.m:
+        for construction_ef in args.construction_ef:
+            for search_ef in args.search_ef:
+                result = measure_configuration(
+                    client, index_vectors, query_vectors, exact, args.k, m, construction_ef, search_ef)
+                results.append(result)
+                print(f"{m:>4} {construction_ef:>5} {search_ef:>5} {result['recall']:>7.3f} "
+                      f"{result['p50_ms']:>7.2f} {result['p95_ms']:>7.2f} {result['build_ms']:>9.0f}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate HNSW settings against stored embeddings.")
+    parser.add_argument("--embeddings-dir", default=EMBEDDINGS_DIRECTORY, help="Directory of saved embeddings")
+    parser.add_argument("--file", action="append", dest="files", metavar="FILE_NAME",
+                        help="Calibrate this uploaded file's collection on its own; may be repeated")
+    parser.add_argument("--server", action="store_true",
+                        help="Measure through the running ChromaDB server instead of an in-process index")
+    parser.add_argument("--k", type=int, default=5, help="Neighbours per query, as in retrieval")
+    parser.add_argument("--queries", type=int, default=200, help="Held-out vectors used as queries")
+    parser.add_argument("--target-p95-ms", type=float, default=10.0, help="Target p95 query latency")
+    parser.add_argument("--m", type=parse_int_list, default=[8, 16, 32], help="Comma-separated M values")
+    parser.add_argument("--construction-ef", type=parse_int_list, default=[64, 100, 200],
+                        help="Comma-separated construction_ef values")
+    parser.add_argument("--search-ef", type=parse_int_list, default=[10, 20, 50, 100],
+                        help="Comma-separated search_ef values")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the query split")
+    args = parser.parse_args()
+
+    if args.server:
+        client = chromadb.HttpClient(host='localhost', port=8001)  # ChromaDB port
+        print("Latency is measured through the ChromaDB server, including the HTTP round trip.")
+    else:
+        client = chromadb.EphemeralClient()
+        print("Latency is measured on an in-process index and excludes ChromaDB's HTTP round trip; "
+              "use --server to measure what the app sees.")
+
+    for file_name in args.files or [None]:
+        if file_name is None:
+            print(f"All files in {args.embeddings_dir}, merged into one index:")
+            vectors = load_stored_embeddings(args.embeddings_dir)
+        else:
+            print(f"{file_name}:")
+            vectors = load_stored_embeddings(paths=[os.path.join(args.embeddings_dir, f"{file_name}.json")])
+
+        best = recommend(calibrate(client, vectors, args), args.target_p95_ms)
+        if best is None:
+            continue
+        if best["p95_ms"] > args.target_p95_ms:
+            print(f"No configuration meets p95 <= {args.target_p95_ms} ms; the fastest is shown instead.")
+        summary = f"(recall@{args.k}={best['recall']:.3f}, p95={best['p95_ms']:.2f} ms)"
+        if file_name is None:
+            print(f"Recommended: HNSW_M={best['m']} HNSW_CONSTRUCTION_EF={best['construction_ef']} "
+                  f"HNSW_SEARCH_EF={best['search_ef']} {summary}")
+        else:
+            print(f"Recommended for {file_name}: /tune-collection/?file_name={file_name}&hnsw_m={best['m']}"
+                  f"&construction_ef={best['construction_ef']}&search_ef={best['search_ef']} {summary}")
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,239 @@
+import os
+import threading
 import chromadb
 
+# Default HNSW index parameters (ChromaDB's own defaults unless overridden)
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_CONSTRUCTION_EF = int(os.getenv("HNSW_CONSTRUCTION_EF", "100"))
+HNSW_SEARCH_EF = int(os.getenv("HNSW_SEARCH_EF", "10"))
+
+# Structural metadata kept on each chunk and usable in query filters
+STRUCTURAL_METADATA_KEYS = ("page", "sheet", "row_start", "row_end", "section")
+
+# Largest number of records sent to or read from ChromaDB in one call
+ADD_BATCH_SIZE = 1000
+
+# Suffix of the temporary copy a collection is built under before being swapped in. Collection names
+# derived from uploads never contain a ".", so it cannot clash with a real collection.
+REBUILD_SUFFIX = ".rebuild"
+
+# Longest a query waits for a collection being swapped in, in seconds
+SWAP_WAIT_SECONDS = float(os.getenv("COLLECTION_SWAP_WAIT_SECONDS", "30"))
+
+# Collections between deletion and rename in `swap_in_collection`
+_swapping = set()
+_swapping_condition = threading.Condition()
+
+# Metadata flag marking collections created by this app, so other collections on the
+# same ChromaDB server are never treated as orphans
+MANAGED_METADATA_KEY = "multi_doc_chat:managed"
+
+# Function to derive the ChromaDB collection name used for an uploaded file
+def get_collection_name(file_name):
+    """
+    Gets the name of the ChromaDB collection holding a file's embeddings.
+
+    Args:
+        file_name (str): The name of the uploaded file.
+
+    Returns:
+        str: The collection name.
+    """
+    return file_name.replace(" ", "_").split(".")[0]
+
+# Function to tell temporary rebuild copies apart from file collections
+def is_rebuild_collection(collection_name):
+    """
+    Checks whether a collection is the temporary copy made by `swap_in_collection`.
+
+    Args:
+        collection_name (str): The collection name.
+
+    Returns:
+        bool: True for a rebuild copy.
+    """
+    return collection_name.endswith(REBUILD_SUFFIX)
+
+# Function to tell collections created by this app apart from other collections
+def is_managed_collection(metadata):
+    """
+    Checks whether a collection was created by this app.
+
+    Args:
+        metadata (dict): The collection's metadata.
+
+    Returns:
+        bool: True if the collection carries the managed flag.
+    """
+    return bool((metadata or {}).get(MANAGED_METADATA_KEY))
+
+# Function to add records to a collection without exceeding ChromaDB's batch size
+def add_in_batches(collection, ids, embeddings, documents, metadatas):
+    """
+    Adds records to a collection in batches of at most ADD_BATCH_SIZE.
+
+    Args:
+        collection (chromadb.Collection): The collection to add to.
+        ids (List[str]): Record ids.
+        embeddings (List): Record embeddings.
+        documents (List[str]): Record documents.
+        metadatas (List[dict]): Record metadata.
+    """
+    for start in range(0, len(ids), ADD_BATCH_SIZE):
+        end = start + ADD_BATCH_SIZE
+        collection.add(
+            ids=ids[start:end],
+            embeddings=embeddings[start:end],
+            documents=documents[start:end],
+            metadatas=metadatas[start:end],
+        )
+
+# Function to read every record of a collection in batches
+def get_all_in_batches(collection):
+    """
+    Reads every record of a collection in batches of at most ADD_BATCH_SIZE.
+
+    Args:
+        collection (chromadb.Collection): The collection to read.
+
+    Returns:
+        dict: Lists of `ids`, `embeddings`, `documents` and `metadatas`.
+    """
+    data = {"ids": [], "embeddings": [], "documents": [], "metadatas": []}
+    offset = 0
+    while True:
+        batch = collection.get(include=["embeddings", "documents", "metadatas"],
+                               limit=ADD_BATCH_SIZE, offset=offset)
+        if not len(batch["ids"]):
+            return data
+        for key in data:
+            data[key].extend(batch[key])
+        offset += len(batch["ids"])
+
+# Function to build the HNSW index settings for a collection
+def build_hnsw_metadata(m=None, construction_ef=None, search_ef=None):
+    """
+    Builds the collection metadata configuring its HNSW index.
+
+    Args:
+        m (int): Maximum neighbours per node. Higher improves recall at the cost of memory and build time.
+        construction_ef (int): Candidate list size while building the index.
+        search_ef (int): Candidate list size while searching. Higher improves recall at the cost of latency.
+
+    Returns:
+        dict: Collection metadata with the `hnsw:*` settings and the managed flag.
+    """
+    return {
+        MANAGED_METADATA_KEY: True,
+        "hnsw:space": "cosine",
+        "hnsw:M": m or HNSW_M,
+        "hnsw:construction_ef": construction_ef or HNSW_CONSTRUCTION_EF,
+        "hnsw:search_ef": search_ef or HNSW_SEARCH_EF,
+    }
+
+# Function to wait until a collection is no longer being swapped in
+def wait_for_swap(collection_name, timeout=SWAP_WAIT_SECONDS):
+    """
+    Blocks while `collection_name` is being swapped in, i.e. between the deletion
+    of the live collection and the rename of its replacement, so queries in this
+    process wait for the new collection instead of failing.
+
+    Args:
+        collection_name (str): The collection about to be queried.
+        timeout (float): Longest time to wait, in seconds.
+    """
+    with _swapping_condition:
+        _swapping_condition.wait_for(lambda: collection_name not in _swapping, timeout=timeout)
+
+# Function to build a collection under a temporary name and swap it in for the live one
+def swap_in_collection(client, collection_name, metadata, data):
+    """
+    Builds a collection from scratch under a temporary name and then moves it to
+    `collection_name`, replacing the live collection only once the copy is complete.
+    Queries in this process wait for the swap, see `wait_for_swap`. The temporary copy is never touched by storage reconciliation, so it survives
+    as a backup if the switch-over fails.
+
+    Args:
+        client (chromadb.HttpClient): The ChromaDB client.
+        collection_name (str): Name the collection ends up under.
+        metadata (dict): Collection metadata, including its HNSW settings.
+        data (dict): Lists of `ids`, `embeddings`, `documents` and `metadatas` to store.
+
+    Returns:
+        chromadb.Collection: The swapped-in collection.
+    """
+    # Build the copy in a fresh collection, dropping any leftover from a failed run
+    temporary_name = f"{collection_name}{REBUILD_SUFFIX}"
+    try:
+        client.delete_collection(temporary_name)
+    except Exception:
+        pass
+    collection = client.create_collection(name=temporary_name, metadata=metadata)
+    add_in_batches(collection, data["ids"], data["embeddings"], data["documents"], data["metadatas"])
+
+    # ChromaDB cannot rename over an existing collection, so queries are held back meanwhile
+    with _swapping_condition:
+        _swapping.add(collection_name)
+    try:
+        try:
+            client.delete_collection(collection_name)
+        except Exception:
+            pass
+        try:
+            collection.modify(name=collection_name)
+            return collection
+        except Exception as e:
+            # Recreate the collection from the data in hand; the copy stays as a backup until that succeeds
+            print(f"Error renaming {temporary_name}, recreating {collection_name}: {e}")
+            restored = client.create_collection(name=collection_name, metadata=metadata)
+            add_in_batches(restored, data["ids"], data["embeddings"], data["documents"], data["metadatas"])
+            client.delete_collection(temporary_name)
+            return restored
+    finally:
+        with _swapping_condition:
+            _swapping.discard(collection_name)
+            _swapping_condition.notify_all()
+
 # Store embeddings in ChromaDB
-def chromadb_vector_store(embeddings, paragraphs, collection_name):
+def chromadb_vector_store(embeddings, paragraphs, collection_name, metadatas=None, hnsw_config=None):
     """
-    Stores embeddings in a ChromaDB collection.
+    Stores embeddings in a ChromaDB collection. The collection is rebuilt from
+    scratch on every (re)process and only replaces the existing one once fully
+    built, so a failed run leaves the previous collection in place.
 
     Args:
         embeddings (List): List of embeddings to store.
         paragraphs (List[str]): List of text paragraphs corresponding to the embeddings.
         collection_name (str): Name of the ChromaDB collection.
+        metadatas (List[dict]): Optional structural metadata for each paragraph,
+            such as its page, sheet, row range or section.
+        hnsw_config (dict): Optional `m`, `construction_ef` and `search_ef` for the
+            collection's HNSW index.
 
     Returns:
-        chromadb.Collection: The collection where embeddings are stored.
+        chromadb.Collection: The collection where embeddings are stored, or None if storing failed.
     """
     try:
-        client = chromadb.HttpClient(host='localhost', port=8001)  # ChromaDB port
-        collection = client.get_or_create_collection(
-            name=collection_name, metadata={"hnsw:space": "cosine"})
-
-        # Add embeddings to the collection
         n = len(paragraphs)
-        collection.add(
-            ids=[str(id) for id in range(n)],
-            embeddings=[embedding for embedding in embeddings],
-            documents=[paragraph for paragraph in paragraphs],
-            metadatas=[{"doc_id": i} for i in range(n)],
-        )
+        if not n or len(embeddings) != n:
+            raise ValueError(f"Expected {n} embeddings for {n} paragraphs, got {len(embeddings)}")
+
+        client = chromadb.HttpClient(host='localhost', port=8001)  # ChromaDB port
+        metadatas = metadatas or [{}] * n
+        # A fresh collection, since `add` ignores existing ids and HNSW settings are fixed at creation
+        collection = swap_in_collection(client, collection_name, build_hnsw_metadata(**(hnsw_config or {})), {
+            "ids": [str(id) for id in range(n)],
+            "embeddings": [embedding for embedding in embeddings],
+            "documents": [paragraph for paragraph in paragraphs],
+            "metadatas": [
+                {
+                    "doc_id": i,
+                    **{key: value for key, value in metadatas[i].items()
+                       if key in STRUCTURAL_METADATA_KEYS and value is not None},
+                }
+                for i in range(n)
+            ],
+        })
 
         print("Stored embeddings in ChromaDB collection")
         return collection
@@ -33,6 +241,75 @@ def chromadb_vector_store(embeddings, paragraphs, collection_name):
         print(f"Error storing embeddings in ChromaDB: {e}")
         return None
 
+# Function to rebuild a collection with new HNSW settings
+def rebuild_collection(collection_name, hnsw_config):
+    """
+    Rebuilds an existing collection with new HNSW settings. ChromaDB fixes a
+    collection's index settings at creation, so the data is copied into a fresh
+    collection that is then swapped in, see `swap_in_collection`.
+
+    Args:
+        collection_name (str): Name of the ChromaDB collection.
+        hnsw_config (dict): `m`, `construction_ef` and/or `search_ef`; unset values keep their current setting.
+
+    Returns:
+        dict: The rebuilt collection's metadata, or None if the rebuild failed.
+    """
+    try:
+        client = chromadb.HttpClient(host='localhost', port=8001)  # ChromaDB port
+        collection = client.get_collection(name=collection_name)
+        current = collection.metadata or {}
+        metadata = build_hnsw_metadata(
+            m=hnsw_config.get("m") or current.get("hnsw:M"),
+            construction_ef=hnsw_config.get("construction_ef") or current.get("hnsw:construction_ef"),
+            search_ef=hnsw_config.get("search_ef") or current.get("hnsw:search_ef"),
+        )
+        swap_in_collection(client, collection_name, metadata, get_all_in_batches(collection))
+
+        print(f"Rebuilt collection {collection_name} with {metadata}")
+        return metadata
+    except Exception as e:
+        print(f"Error rebuilding collection in ChromaDB: {e}")
+        return None
+
+# Function to build a ChromaDB `where` filter from structural constraints
+def build_where_filter(page_start=None, page_end=None, sheets=None, row_start=None, row_end=None, sections=None):
+    """
+    Builds a ChromaDB metadata filter restricting a query to part of a document.
+    Constraints are combined with AND, so page and sheet constraints together match no chunk.
+
+    Args:
+        page_start (int): First page to search, inclusive.
+        page_end (int): Last page to search, inclusive.
+        sheets (List[str]): Sheet names to search.
+        row_start (int): First spreadsheet row to search, inclusive.
+        row_end (int): Last spreadsheet row to search, inclusive.
+        sections (List[str]): Section headings to search.
+
+    Returns:
+        dict: A `where` clause for `collection.query`, or None if there are no constraints.
+    """
+    conditions = []
+    if page_start is not None:
+        conditions.append({"page": {"$gte": page_start}})
+    if page_end is not None:
+        conditions.append({"page": {"$lte": page_end}})
+    if sheets:
+        conditions.append({"sheet": {"$in": list(sheets)}})
+    # Keep any chunk whose row range overlaps the requested one
+    if row_start is not None:
+        conditions.append({"row_end": {"$gte": row_start}})
+    if row_end is not None:
+        conditions.append({"row_start": {"$lte": row_end}})
+    if sections:
+        conditions.append({"section": {"$in": list(sections)}})
+
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
+
 # Function to delete the embeddings and collection from ChromaDB
 def delete_from_chromadb(collection_name):
     """
@@ -40,6 +317,9 @@ def delete_from_chromadb(collection_name):
 
     Parameters:
     collection_name (str): The name of the collection to delete.
+
+    Returns:
+    bool: True if the collection was deleted.
     """
     try:
         client = chromadb.HttpClient(host='localhost', port=8001)  # ChromaDB port
@@ -47,6 +327,9 @@ def delete_from_chromadb(collection_name):
         if collection:
             client.delete_collection(collection_name)
             print(f"Collection {collection_name} deleted from ChromaDB")
+            return True
+        return False
     except Exception as e:
         print(f"Error deleting collection from ChromaDB: {e}")
+        return False
 
@@ -2,6 +2,12 @@ import streamlit as st
 from PIL import Image
 import requests
 import os
+import uuid
+import json
+import time
+
+# Minimum seconds between re-renders of a streaming answer
+RENDER_INTERVAL = 0.1
 
 # Set page to wide mode
 st.set_page_config(layout="wide")
@@ -19,6 +25,12 @@ if 'selected_files' not in st.session_state:
 if 'deleted_files' not in st.session_state:
     st.session_state['deleted_files'] = set()  # Use set for faster lookup
 
+if 'user_id' not in st.session_state:
+    st.session_state['user_id'] = uuid.uuid4().hex  # Identifies this session for fair queueing
+
+if 'conversation_id' not in st.session_state:
+    st.session_state['conversation_id'] = uuid.uuid4().hex  # Lets follow-up questions reuse retrieved chunks
+
 # Function to get file extension
 def get_file_extension(file_name):
     """
@@ -49,6 +61,55 @@ def get_icon_path(file_extension):
         icon_path = os.path.join(icon_folder, "default.png")
     return icon_path
 
+# Function to parse server-sent events from a streaming response
+def iter_sse_events(response):
+    """
+    Parse server-sent events from a streaming HTTP response.
+
+    Args:
+        response (requests.Response): The streaming response.
+
+    Yields:
+        tuple: The event name and its decoded JSON payload.
+    """
+    event, data_lines = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if line is None:
+            continue
+        if line == "":
+            if data_lines:
+                yield event, json.loads("\n".join(data_lines))
+            event, data_lines = "message", []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data_lines.append(line[len("data:"):].lstrip())
+
+# Function to describe where a source chunk came from
+def format_source(source):
+    """
+    Format a source returned by the backend for display.
+
+    Args:
+        source (dict): The source with its collection, id and metadata.
+
+    Returns:
+        str: A short description of the source, including its location when known.
+    """
+    metadata = source.get("metadata") or {}
+    location = []
+    if "page" in metadata:
+        location.append(f"p. {metadata['page']}")
+    if "sheet" in metadata:
+        location.append(f"sheet {metadata['sheet']}")
+    if "row_start" in metadata:
+        location.append(f"rows {metadata['row_start']}-{metadata.get('row_end', metadata['row_start'])}")
+    if "section" in metadata:
+        location.append(f"§ {metadata['section']}")
+    if not location:
+        location.append(f"chunk {source['id']}")
+    return f"{source['collection']} ({', '.join(location)})"
+
 # Sidebar for file uploading and selection
 st.sidebar.header("Upload and Select File(s)")
 
@@ -132,6 +193,27 @@ if st.session_state.file_names:
     )
     st.session_state['selected_files'] = selected_files
 
+    # Optional filters narrowing the search to part of the selected documents
+    with st.sidebar.expander("Search filters"):
+        st.caption(
+            "Only chunks matching every filter set are searched. Pages apply to PDFs, sheets and rows "
+            "to spreadsheets and sections to Word documents, so combining them across file types matches nothing."
+        )
+        page_start = st.number_input("From page", min_value=0, value=0, help="0 searches all pages")
+        page_end = st.number_input("To page", min_value=0, value=0, help="0 searches all pages")
+        sheets = st.text_input("Sheets", help="Comma-separated sheet names")
+        row_start = st.number_input("From row", min_value=0, value=0, help="0 searches all rows")
+        row_end = st.number_input("To row", min_value=0, value=0, help="0 searches all rows")
+        sections = st.text_input("Sections", help="Comma-separated section headings")
+    st.session_state['filters'] = {
+        'page_start': page_start or None,
+        'page_end': page_end or None,
+        'sheets': [sheet.strip() for sheet in sheets.split(',') if sheet.strip()] or None,
+        'row_start': row_start or None,
+        'row_end': row_end or None,
+        'sections': [section.strip() for section in sections.split(',') if section.strip()] or None,
+    }
+
 # Display chat history using st.chat_message
 st.subheader("CDOC: Chat with your Documents")
 for msg in st.session_state.chat_history:
@@ -167,24 +249,51 @@ if prompt:
         # Display Assistant response with streaming support
         data = {
             'question': prompt,
-            'file_names': st.session_state['selected_files']
+            'file_names': st.session_state['selected_files'],
+            'user_id': st.session_state['user_id'],
+            'filters': st.session_state.get('filters'),
+            'conversation_id': st.session_state['conversation_id']
         }
 
-        response = requests.post("http://127.0.0.1:8000/ask-question/", json=data, stream=True)
+        # Closing the response when the script stops or reruns drops the connection, which cancels the generation
+        with requests.post("http://127.0.0.1:8000/ask-question/", json=data, stream=True) as response:
+            if response.status_code == 200:
+                sources, timings, error = [], {}, None
+                last_render = 0.0
+                for event, payload in iter_sse_events(response):
+                    if event == "queue":
+                        message_placeholder.markdown(f"_Waiting in queue (position {payload['position']})..._")
+                    elif event == "token":
+                        response_text += payload["text"]
+                        # Re-render on a time-based throttle instead of on every event
+                        if time.monotonic() - last_render >= RENDER_INTERVAL:
+                            message_placeholder.markdown(response_text)
+                            last_render = time.monotonic()
+                    elif event == "done":
+                        sources, timings = payload.get("sources", []), payload.get("timings", {})
+                    elif event == "error":
+                        error = payload.get('error', 'Unknown error')
+                message_placeholder.markdown(response_text)
 
-        if response.status_code == 200:
-            for chunk in response.iter_content(chunk_size=1024):
-                if chunk:
-                    response_text += chunk.decode('utf-8')
-                    message_placeholder.markdown(response_text)
-            
-            # Append the full response to chat history
-            st.session_state['chat_history'].append({
-                'role': 'Assistant',
-                'content': response_text
-            })
-        else:
-            st.write("Error Details:", response.json())  # Print the error details
-            answer = f"Error {response.status_code}: {response.text}"
+                if error:
+                    # Show the failure in the assistant's turn and keep it out of the chat history
+                    with assistant_message:
+                        st.error(f"Error generating response: {error}")
+                else:
+                    if sources:
+                        with assistant_message:
+                            st.caption(
+                                "Sources: " + "; ".join(format_source(source) for source in sources)
+                                + (f" | {timings['total_ms'] / 1000:.1f}s" if "total_ms" in timings else "")
+                            )
+
+                    # Append the full response to chat history
+                    st.session_state['chat_history'].append({
+                        'role': 'Assistant',
+                        'content': response_text
+                    })
+            else:
+                st.write("Error Details:", response.json())  # Print the error details
+                answer = f"Error {response.status_code}: {response.text}"
     else:
         st.warning("Please select file(s) and enter a message.")
\ No newline at end of file